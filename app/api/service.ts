@@ -1,7 +1,7 @@
 /**
  * API Service for communicating with the backend
  */
-import { GraphData, HealthResponse, ProcessTextRequest } from './types';
+import { AttentionWeights, GraphData, HealthResponse, ProcessTextRequest, ProcessTextResponse } from './types';
 import { SUPPORTED_MODELS, SupportedModel } from '../config/models';
 
 // Get the API URL from environment or use default
@@ -68,6 +68,21 @@ export const getAvailableModels = async (): Promise<SupportedModel[]> => {
   }
 };
 
+/**
+ * Decode the backend's base64 uint8 attention tensor
+ * @param weights Encoded tensor of shape [layers, heads, destToken, sourceToken]
+ * @returns Flattened weights in the same order
+ */
+const decodeAttentionWeights = (weights: AttentionWeights): Float32Array => {
+  const bytes = Uint8Array.from(atob(weights.data), c => c.charCodeAt(0));
+  
+  const decoded = new Float32Array(bytes.length);
+  for (let i = 0; i < bytes.length; i++) {
+    decoded[i] = bytes[i] * weights.scale;
+  }
+  return decoded;
+};
+
 /**
  * Process text with the specified model
  * @param text Text to process
@@ -92,7 +107,11 @@ export const processText = async (text: string, modelName: SupportedModel): Prom
     throw new Error(`Error ${response.status}: ${errorText || 'Failed to process text'}`);
   }
   
-  return await response.json();
+  const result: ProcessTextResponse = await response.json();
+  return {
+    ...result,
+    attentionWeights: decodeAttentionWeights(result.attentionWeights),
+  };
 };
 
 const apiService = {
@@ -2,14 +2,15 @@
  * Type definitions for API requests and responses
  */
 
-export interface AttentionPattern {
-  sourceLayer: number;
-  sourceToken: number;
-  destLayer: number;
-  destToken: number;
-  weight: number;
-  head: number;
-  headType?: string;
+/**
+ * Dense attention tensor as sent by the backend: base64-encoded uint8 values
+ * of shape [layers, heads, destToken, sourceToken], to be multiplied by scale.
+ */
+export interface AttentionWeights {
+  shape: [number, number, number, number];
+  dtype: 'uint8';
+  scale: number;
+  data: string;
 }
 
 export interface ModelInfo {
@@ -23,12 +24,18 @@ export interface GraphData {
   numLayers: number;
   numTokens: number;
   numHeads: number;
-  attentionPatterns: AttentionPattern[];
+  // Attention weights indexed as [layer][head][destToken][sourceToken], flattened
+  attentionWeights: Float32Array;
+  headTypes?: string[][];
   tokens?: string[];
   model_name?: string;
   model_info?: ModelInfo;
 }
 
+export interface ProcessTextResponse extends Omit<GraphData, 'attentionWeights'> {
+  attentionWeights: AttentionWeights;
+}
+
 export interface HealthResponse {
   status: string;
   loaded_models?: string[];
@@ -64,16 +64,6 @@ const svgOptimizationStyles = `
   }
 `;
 
-interface AttentionPattern {
-  sourceLayer: number;
-  sourceToken: number;
-  destLayer: number;
-  destToken: number;
-  weight: number;
-  head: number;
-  headType?: string;
-} 
-
 interface HeadPair {
   layer: number;
   head: number;
@@ -90,7 +80,8 @@ interface GraphData {
   numLayers: number;
   numTokens: number;
   numHeads: number;
-  attentionPatterns: AttentionPattern[];
+  attentionWeights: Float32Array;  // Indexed as [layer][head][destToken][sourceToken], flattened
+  headTypes?: string[][];
   tokens?: string[];  // Optional array of actual tokens
   model_name?: string;
   model_info?: {
@@ -159,7 +150,7 @@ const AttentionFlowGraph = () => {
     numLayers: 4,
     numTokens: 5,
     numHeads: 4,
-    attentionPatterns: [],
+    attentionWeights: new Float32Array(0),
     tokens: Array(5).fill('token')
   });
   const [threshold, setThreshold] = useState(0.4);
@@ -554,20 +545,31 @@ const AttentionFlowGraph = () => {
     
     // Filter edges based on threshold and visible heads
     const visibleHeadPairs = getVisibleHeads();
-    const links: Link[] = data.attentionPatterns
-      .filter(edge => {
-        const isVisible = visibleHeadPairs.some(h => 
-          h.layer === edge.sourceLayer && h.head === edge.head
-        );
-        return edge.weight >= threshold && isVisible;
-      })
-      .map(edge => ({
-        source: `${edge.sourceLayer}-${edge.sourceToken}`,
-        target: `${edge.destLayer}-${edge.destToken}`,
-        weight: edge.weight,
-        head: edge.head,
-        groupId: getHeadGroup(edge.sourceLayer, edge.head) ?? -1
-      }));
+    const links: Link[] = [];
+    const seenHeads = new Set<string>();
+    const numTokens = data.numTokens;
+    visibleHeadPairs.forEach(({ layer, head }) => {
+      // Skip duplicates and heads outside the loaded model
+      const key = `${layer}-${head}`;
+      if (seenHeads.has(key) || layer >= data.numLayers - 1 || head >= data.numHeads) return;
+      seenHeads.add(key);
+      
+      const groupId = getHeadGroup(layer, head) ?? -1;
+      const headOffset = (layer * data.numHeads + head) * numTokens * numTokens;
+      for (let destToken = 0; destToken < numTokens; destToken++) {
+        for (let sourceToken = 0; sourceToken < numTokens; sourceToken++) {
+          const weight = data.attentionWeights[headOffset + destToken * numTokens + sourceToken];
+          if (weight < threshold) continue;
+          links.push({
+            source: `${layer}-${sourceToken}`,
+            target: `${layer + 1}-${destToken}`,
+            weight,
+            head,
+            groupId
+          });
+        }
+      }
+    });
     
     // Use a single container for better performance
     const g = svg.append("g").attr("class", "graph-container");
@@ -779,7 +781,7 @@ const AttentionFlowGraph = () => {
   // Draw the graph whenever relevant state changes
   useEffect(() => {
     // Only draw the graph if we have attention patterns data and no errors
-    if (!data.attentionPatterns.length || loading) return;
+    if (!data.attentionWeights.length || loading) return;
     
     // Use the debounced version for smoother performance
     debouncedDrawGraph();
@@ -1,9 +1,21 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
-from .model import AttentionPatternExtractor, AVAILABLE_MODELS
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from cachetools import LRUCache
+from transformer_lens.loading_from_pretrained import get_pretrained_model_config
+from .model import AttentionPatternExtractor, AVAILABLE_MODELS, WEIGHT_SCALE, PromptTooLongError
+from .batcher import AttentionBatcher
+import asyncio
+import base64
+import hashlib
 import logging
+import os
+import struct
+import numpy as np
+import orjson
+import torch
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,7 +25,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Attention Pattern API",
     description="API for extracting attention patterns from transformer models",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -23,64 +36,354 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Attention-Shape", "X-Attention-Dtype", "X-Attention-Scale"],
 )
 
 # Create a model registry to hold model instances
 model_registry = {}
+# Request batchers per loaded model; all forward passes go through these
+batchers: Dict[str, AttentionBatcher] = {}
 
-# Initialize default model
-try:
-    default_model_name = "gpt2-small"
-    model_registry[default_model_name] = AttentionPatternExtractor(default_model_name)
-    logger.info(f"Default model '{default_model_name}' initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize default model: {str(e)}")
-    raise
+# Serialized /process responses keyed by (model name, text digest), bounded by total size
+RESPONSE_CACHE_BYTES = 128 * 1024 * 1024
+response_cache: LRUCache = LRUCache(maxsize=RESPONSE_CACHE_BYTES, getsizeof=len)
+# In-flight /process runs with the same keys, so concurrent identical requests share one run
+response_runs: Dict[Tuple[str, bytes], asyncio.Future] = {}
+
+# Responses with more attention weights than this are streamed in chunks
+# instead of being serialized (and cached) in one piece
+STREAM_ATTENTION_CELLS = 5_000_000
+# Bytes of the attention tensor per streamed chunk; a multiple of 3 so every
+# chunk base64-encodes without padding
+STREAM_CHUNK_SIZE = 3 << 18  # 768 KiB
+
+# /process/raw bodies start with the length of their JSON metadata block, as a little-endian uint32
+RAW_METADATA_LENGTH_FORMAT = "<I"
+
+# In-flight model loads, so concurrent requests for the same model share one load
+model_loads: Dict[str, asyncio.Future] = {}
+# Loads run one at a time so each one sees the GPU memory left by the previous ones
+model_load_lock = asyncio.Lock()
+
+# Models loaded in the background at startup (comma-separated, empty to disable)
+PRELOAD_MODELS = [
+    name for name in os.environ.get("PRELOAD_MODELS", ",".join(AVAILABLE_MODELS)).split(",") if name
+]
+# Background task loading PRELOAD_MODELS; referenced here so it isn't garbage-collected mid-run
+preload_task: Optional[asyncio.Task] = None
+# Free GPU memory required per byte of weights before a model is put on the GPU
+GPU_MEMORY_HEADROOM = 1.5
 
 class TextRequest(BaseModel):
     text: str
     model_name: Optional[str] = "gpt2-small"
 
+def choose_device(model_name: str) -> str:
+    """Pick the device to load a model on.
+    
+    Models go on the GPU only if their bfloat16 weights (plus headroom for
+    activations) fit in the currently free GPU memory, otherwise on the CPU.
+    
+    Args:
+        model_name: Name of the model to load
+        
+    Returns:
+        "cuda" or "cpu"
+    """
+    if not torch.cuda.is_available():
+        return "cpu"
+    
+    try:
+        n_params = get_pretrained_model_config(AVAILABLE_MODELS[model_name]).n_params
+    except Exception as e:
+        logger.warning(f"Could not estimate size of model '{model_name}', loading on GPU: {str(e)}")
+        return "cuda"
+    
+    free_bytes, _ = torch.cuda.mem_get_info()
+    needed_bytes = n_params * 2 * GPU_MEMORY_HEADROOM  # 2 bytes per bfloat16 weight
+    if needed_bytes > free_bytes:
+        logger.warning(f"Not enough free GPU memory for model '{model_name}', loading on CPU")
+        return "cpu"
+    return "cuda"
+
+def load_model(model_name: str) -> AttentionPatternExtractor:
+    """Load a model and add it to the registry. Blocking, run in a worker thread.
+    
+    Args:
+        model_name: Name of the model to load
+        
+    Returns:
+        The loaded AttentionPatternExtractor
+    """
+    device = choose_device(model_name)
+    logger.info(f"Loading model '{model_name}' on {device}...")
+    extractor = AttentionPatternExtractor(model_name, device=device)
+    model_registry[model_name] = extractor
+    logger.info(f"Model '{model_name}' loaded successfully")
+    return extractor
+
+async def load_model_async(model_name: str) -> AttentionPatternExtractor:
+    """Load a model in a worker thread so the event loop keeps serving requests."""
+    async with model_load_lock:
+        if model_name in model_registry:
+            return model_registry[model_name]
+        return await asyncio.to_thread(load_model, model_name)
+
+async def get_model(model_name: str) -> AttentionPatternExtractor:
+    """Return the extractor for a model, loading it on first use.
+    
+    Args:
+        model_name: Name of the model to use
+        
+    Returns:
+        The loaded AttentionPatternExtractor
+    """
+    # Validate model name
+    if model_name not in AVAILABLE_MODELS:
+        raise HTTPException(status_code=400, detail=f"Model '{model_name}' not supported. Available models: {', '.join(AVAILABLE_MODELS.keys())}")
+    
+    if model_name in model_registry:
+        return model_registry[model_name]
+    
+    # Load model if not already loaded, joining a load that is already running
+    load = model_loads.get(model_name)
+    if load is None:
+        load = model_loads[model_name] = asyncio.ensure_future(load_model_async(model_name))
+        load.add_done_callback(lambda _: model_loads.pop(model_name, None))
+    try:
+        # Shielded so a cancelled request doesn't abort a load other requests wait on
+        return await asyncio.shield(load)
+    except Exception as e:
+        logger.error(f"Failed to load model '{model_name}': {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to load model '{model_name}': {str(e)}")
+
+async def get_batcher(model_name: str) -> AttentionBatcher:
+    """Return the request batcher for a model, loading the model on first use.
+    
+    Args:
+        model_name: Name of the model to use
+        
+    Returns:
+        The AttentionBatcher running the model
+    """
+    extractor = await get_model(model_name)
+    if model_name not in batchers:
+        batchers[model_name] = AttentionBatcher(extractor)
+    return batchers[model_name]
+
+def response_cache_key(model_name: str, text: str) -> Tuple[str, bytes]:
+    """Build the response cache key for a request.
+    
+    Args:
+        model_name: Name of the model used
+        text: Input text
+        
+    Returns:
+        Tuple of the model name and a 128-bit digest of the text
+    """
+    return model_name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+async def tokenize_text(extractor: AttentionPatternExtractor, text: str) -> torch.Tensor:
+    """Tokenize a text in a worker thread, rejecting texts whose attention tensor is too large to export.
+    
+    Args:
+        extractor: Extractor the text will run on
+        text: Input text
+        
+    Returns:
+        Token ids of the text, as returned by AttentionPatternExtractor.tokenize
+    """
+    try:
+        return await asyncio.to_thread(extractor.tokenize, text)
+    except PromptTooLongError as e:
+        logger.warning(str(e))
+        raise HTTPException(status_code=413, detail=str(e))
+
+async def submit_text(batcher: AttentionBatcher, model_name: str, text: str,
+                      token_ids: torch.Tensor) -> Tuple[List[str], np.ndarray, List[List[str]]]:
+    """Run the model on a tokenized text through its batcher.
+    
+    Args:
+        batcher: Batcher running the model
+        model_name: Name of the model used
+        text: Input text, for logging
+        token_ids: Token ids of the text, as returned by tokenize_text
+        
+    Returns:
+        Tuple in the format of AttentionPatternExtractor.get_attention_weights
+    """
+    try:
+        logger.info(f"Processing text with model '{model_name}': {text[:50]}...")
+        return await batcher.submit(token_ids)
+    except PromptTooLongError as e:
+        logger.warning(str(e))
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error processing text: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def run_process_text(batcher: AttentionBatcher, model_name: str, text: str,
+                           token_ids: torch.Tensor) -> bytes:
+    """Run the model on a text and serialize the /process response.
+    
+    Args:
+        batcher: Batcher running the model
+        model_name: Name of the model used
+        text: Input text
+        token_ids: Token ids of the text, as returned by tokenize_text
+        
+    Returns:
+        JSON-encoded response body
+    """
+    result = batcher.extractor.format_result(*await submit_text(batcher, model_name, text, token_ids))
+    result["model_name"] = model_name  # Add model name to response
+    logger.info(f"Successfully processed text. Generated attention weights of shape {result['attentionWeights']['shape']}")
+    # Same options as ORJSONResponse, so numpy values serialize natively
+    return orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+async def cache_process_text(batcher: AttentionBatcher, model_name: str, text: str,
+                             token_ids: torch.Tensor, key: Tuple[str, bytes]) -> bytes:
+    """Run run_process_text and store the serialized response in the response cache."""
+    payload = await run_process_text(batcher, model_name, text, token_ids)
+    response_cache[key] = payload
+    return payload
+
+def iter_weight_chunks(weights: np.ndarray) -> Iterator[bytes]:
+    """Yield the attention tensor's bytes STREAM_CHUNK_SIZE at a time."""
+    flat = weights.reshape(-1)
+    for start in range(0, flat.size, STREAM_CHUNK_SIZE):
+        yield flat[start:start + STREAM_CHUNK_SIZE].tobytes()
+
+def iter_raw_body(tokens: List[str], weights: np.ndarray) -> Iterator[bytes]:
+    """Yield the /process/raw body: a length-prefixed JSON block with the tokens, then the tensor."""
+    metadata = orjson.dumps({"tokens": tokens})
+    yield struct.pack(RAW_METADATA_LENGTH_FORMAT, len(metadata)) + metadata
+    yield from iter_weight_chunks(weights)
+
+def stream_process_json(result: Dict[str, Any], weights: np.ndarray) -> Iterator[bytes]:
+    """Serialize a /process response piece by piece.
+    
+    Produces the same JSON as run_process_text, but base64-encodes the tensor
+    one chunk at a time, so neither the encoded tensor nor the whole body is
+    ever held in memory.
+    
+    Args:
+        result: Response formatted without attentionWeights.data
+        weights: Attention weights to encode into attentionWeights.data
+    """
+    attention_weights = result.pop("attentionWeights")
+    # Reopen the serialized objects to append the remaining fields
+    yield orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)[:-1]
+    yield b',"attentionWeights":' + orjson.dumps(attention_weights)[:-1] + b',"data":"'
+    for chunk in iter_weight_chunks(weights):
+        yield base64.b64encode(chunk)
+    yield b'"}}'
+
 @app.post("/process")
-async def process_text(request: TextRequest) -> Dict[str, Any]:
+async def process_text(request: TextRequest) -> Response:
     """Process text and return attention patterns.
     
+    Serialized responses are kept in an LRU cache, so repeated requests for the
+    same model and text skip both the forward pass and JSON encoding. Responses
+    with more than STREAM_ATTENTION_CELLS attention weights are streamed and not
+    cached; texts over the extractor's MAX_ATTENTION_CELLS get a 413.
+    
     Args:
         request: TextRequest object containing the text to analyze and optional model name
         
     Returns:
-        Dictionary containing:
+        JSON response containing:
             - numLayers: number of layers
             - numTokens: number of tokens
             - numHeads: number of attention heads
             - tokens: list of tokens
-            - attentionPatterns: list of attention patterns
+            - attentionWeights: base64 uint8 tensor of shape (layers, heads, dest token, source token),
+              with the scale to multiply it by
+            - headTypes: head type names indexed as [layer][head]
     """
     model_name = request.model_name
+    batcher = await get_batcher(model_name)
+    key = response_cache_key(model_name, request.text)
     
-    # Validate model name
-    if model_name not in AVAILABLE_MODELS:
-        raise HTTPException(status_code=400, detail=f"Model '{model_name}' not supported. Available models: {', '.join(AVAILABLE_MODELS.keys())}")
+    payload = response_cache.get(key)
+    if payload is None:
+        token_ids = await tokenize_text(batcher.extractor, request.text)
+        if batcher.extractor.attention_cells(len(token_ids)) > STREAM_ATTENTION_CELLS:
+            tokens, weights, head_types = await submit_text(batcher, model_name, request.text, token_ids)
+            result = batcher.extractor.format_result(tokens, weights, head_types, encode_data=False)
+            result["model_name"] = model_name
+            logger.info(f"Streaming attention weights of shape {list(weights.shape)}")
+            return StreamingResponse(stream_process_json(result, weights), media_type="application/json")
+        # A run for the same key may have finished while the text was being tokenized
+        payload = response_cache.get(key)
     
-    # Load model if not already loaded
-    if model_name not in model_registry:
-        try:
-            logger.info(f"Loading model '{model_name}'...")
-            model_registry[model_name] = AttentionPatternExtractor(model_name)
-            logger.info(f"Model '{model_name}' loaded successfully")
-        except Exception as e:
-            logger.error(f"Failed to load model '{model_name}': {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Failed to load model '{model_name}': {str(e)}")
+    if payload is None:
+        # Join a run for the same key that is already in flight; the entry is
+        # dropped only once the run has finished, so later requests hit the cache
+        run = response_runs.get(key)
+        if run is None:
+            run = response_runs[key] = asyncio.ensure_future(
+                cache_process_text(batcher, model_name, request.text, token_ids, key)
+            )
+            run.add_done_callback(lambda _: response_runs.pop(key, None))
+        # Shielded so a cancelled request doesn't abort a run other requests wait on
+        payload = await asyncio.shield(run)
+    else:
+        logger.info(f"Serving cached result for model '{model_name}': {request.text[:50]}...")
     
-    try:
-        logger.info(f"Processing text with model '{model_name}': {request.text[:50]}...")
-        result = model_registry[model_name].process_text(request.text)
-        result["model_name"] = model_name  # Add model name to response
-        logger.info(f"Successfully processed text. Generated {len(result['attentionPatterns'])} patterns")
-        return result
-    except Exception as e:
-        logger.error(f"Error processing text: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    return Response(content=payload, media_type="application/json")
+
+@app.post("/process/raw")
+async def process_text_raw(request: TextRequest) -> StreamingResponse:
+    """Process text and return the attention tensor as raw bytes.
+    
+    The body starts with a little-endian uint32 byte length, followed by that
+    many bytes of UTF-8 JSON metadata ({"tokens": [...]}). The rest is a uint8
+    tensor of shape (layers, heads, dest token, source token), to be multiplied
+    by the scale, streamed in chunks of STREAM_CHUNK_SIZE bytes. Shape, dtype and
+    scale are sent in the X-Attention-* headers; the tokens are kept out of the
+    headers, where their size could exceed proxy header limits.
+    
+    Args:
+        request: TextRequest object containing the text to analyze and optional model name
+    """
+    model_name = request.model_name
+    batcher = await get_batcher(model_name)
+    token_ids = await tokenize_text(batcher.extractor, request.text)
+    tokens, weights, _ = await submit_text(batcher, model_name, request.text, token_ids)
+    
+    return StreamingResponse(
+        iter_raw_body(tokens, weights),
+        media_type="application/octet-stream",
+        headers={
+            "X-Attention-Shape": ",".join(str(dim) for dim in weights.shape),
+            "X-Attention-Dtype": "uint8",
+            "X-Attention-Scale": repr(WEIGHT_SCALE)
+        }
+    )
+
+async def preload_models():
+    """Load PRELOAD_MODELS one after another, logging failures."""
+    for model_name in PRELOAD_MODELS:
+        try:
+            await get_model(model_name)
+        except HTTPException as e:
+            # The model will be retried on its first request
+            logger.error(f"Failed to preload model '{model_name}': {e.detail}")
+
+@app.on_event("startup")
+async def start_preloading():
+    """Start loading models in the background so the first requests don't stall."""
+    global preload_task
+    preload_task = asyncio.create_task(preload_models())
+
+@app.on_event("shutdown")
+async def stop_batchers():
+    """Stop the background preloading and batching tasks."""
+    if preload_task is not None and not preload_task.done():
+        # A load already running in a worker thread finishes on its own
+        preload_task.cancel()
+    await asyncio.gather(*(batcher.stop() for batcher in batchers.values()))
 
 @app.get("/models")
 async def list_models():
@@ -100,4 +403,14 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # Run from the backend directory with `python -m attention.api`. Each worker
+    # loads its own copy of every model, so keep one worker per GPU and rely on
+    # the request batcher for concurrency; raise WEB_CONCURRENCY only if memory allows.
+    uvicorn.run(
+        "attention.api:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", 1))
+    ) 
\ No newline at end of file
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .model import AttentionPatternExtractor, MAX_ATTENTION_CELLS
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of texts run together in one forward pass
+MAX_BATCH_SIZE = 8
+# How long to wait for more requests before running a partial batch (seconds)
+MAX_BATCH_WAIT = 0.02
+
+class AttentionBatcher:
+    """Collect concurrent requests for one model and run them as padded batches.
+
+    Requests are queued by submit(); a background task drains the queue into
+    batches of up to max_batch_size texts, whose padded attention tensor stays
+    within MAX_ATTENTION_CELLS, and runs each batch in a worker thread, so the
+    event loop stays free while the model runs. Only one batch
+    runs at a time, which also keeps the model's hooks from being shared
+    between concurrent forward passes.
+    """
+
+    def __init__(self, extractor: AttentionPatternExtractor,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_BATCH_WAIT):
+        """Initialize the batcher.
+
+        Args:
+            extractor: Loaded extractor to run the batches on
+            max_batch_size: Maximum number of texts per forward pass
+            max_wait: Seconds to wait for more requests after the first one arrives
+        """
+        self.extractor = extractor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        # Request taken off the queue that didn't fit in the previous batch
+        self._carry: Optional[Tuple[torch.Tensor, asyncio.Future]] = None
+
+    def start(self):
+        """Start the background batching task on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background batching task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, token_ids: torch.Tensor) -> Tuple[List[str], np.ndarray, List[List[str]]]:
+        """Queue a tokenized text and wait for its attention weights.
+
+        Args:
+            token_ids: Token ids of the text, as returned by AttentionPatternExtractor.tokenize
+
+        Returns:
+            Tuple in the format of AttentionPatternExtractor.get_attention_weights
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((token_ids, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[torch.Tensor, asyncio.Future]]:
+        """Wait for a request, then collect more until the batch is full or max_wait passes.
+
+        A batch is also closed when the next request would push its padded
+        attention tensor over MAX_ATTENTION_CELLS; that request starts the next batch.
+        """
+        loop = asyncio.get_running_loop()
+        if self._carry is not None:
+            batch, self._carry = [self._carry], None
+        else:
+            batch = [await self.queue.get()]
+        seq_len = len(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            padded_len = max(seq_len, len(request[0]))
+            if self.extractor.attention_cells(padded_len, len(batch) + 1) > MAX_ATTENTION_CELLS:
+                self._carry = request
+                break
+            batch.append(request)
+            seq_len = padded_len
+        return batch
+
+    async def _run(self):
+        """Process batches until cancelled."""
+        while True:
+            batch = await self._next_batch()
+            # Skip requests whose callers have gone away
+            batch = [(token_ids, future) for token_ids, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            token_ids = [ids for ids, _ in batch]
+            logger.info(f"Running batch of {len(token_ids)} text(s) with model '{self.extractor.model_name}'")
+            try:
+                results = await asyncio.to_thread(self.extractor.get_attention_weights_from_tokens, token_ids)
+            except Exception as e:
+                if len(batch) == 1:
+                    self._fail(batch[0][1], e)
+                    continue
+                # Don't fail every request for one bad text (or a batch too large
+                # for memory): retry the texts one at a time
+                logger.warning(f"Batch of {len(batch)} text(s) failed, retrying one at a time: {str(e)}")
+                await self._run_individually(batch)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run_individually(self, batch: List[Tuple[torch.Tensor, asyncio.Future]]):
+        """Run each request of a failed batch on its own, failing only the ones that fail again."""
+        for token_ids, future in batch:
+            if future.done():
+                continue
+            try:
+                results = await asyncio.to_thread(self.extractor.get_attention_weights_from_tokens, [token_ids])
+            except Exception as e:
+                self._fail(future, e)
+                continue
+            if not future.done():
+                future.set_result(results[0])
+
+    @staticmethod
+    def _fail(future: asyncio.Future, error: Exception):
+        """Fail a request if its caller is still waiting."""
+        logger.error(f"Error processing text: {str(error)}")
+        if not future.done():
+            future.set_exception(error)
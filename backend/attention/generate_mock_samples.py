@@ -3,6 +3,7 @@ This script generates mock sample attention data for each model.
 It creates the same structure that would be generated by the real models,
 but with artificial data that doesn't require loading the actual models.
 """
+import base64
 import json
 import os
 import random
@@ -23,12 +24,15 @@ def generate_mock_attention_patterns(model_name, num_tokens=10):
     # Generate tokens
     tokens = [f"token_{i}" for i in range(num_tokens)]
     
-    # Generate random attention patterns
-    attention_patterns = []
+    # Generate random attention weights as a (layer, head, dest, src) tensor like the real API
+    weights = np.zeros((num_layers, num_heads, num_tokens, num_tokens), dtype=np.uint8)
+    head_types = []
     
     for layer in range(num_layers):
+        layer_head_types = []
         for head in range(num_heads):
             head_type = random.choice(["induction", "previous_token", "name_mover", "duplicate_token", "unknown"])
+            layer_head_types.append(head_type)
             
             # For each token pair, create attention pattern
             for src_idx in range(num_tokens):
@@ -41,22 +45,21 @@ def generate_mock_attention_patterns(model_name, num_tokens=10):
                         else:
                             weight = random.uniform(0, 0.5)
                             
-                        attention_patterns.append({
-                            "sourceLayer": layer,
-                            "sourceToken": src_idx,
-                            "destLayer": layer + 1,
-                            "destToken": dest_idx,
-                            "weight": weight,
-                            "head": head,
-                            "headType": head_type
-                        })
+                        weights[layer, head, dest_idx, src_idx] = round(weight * 255)
+        head_types.append(layer_head_types)
     
     return {
         "numLayers": num_layers + 1,  # +1 for output layer
         "numTokens": num_tokens,
         "numHeads": num_heads,
         "tokens": tokens,
-        "attentionPatterns": attention_patterns,
+        "attentionWeights": {
+            "shape": list(weights.shape),
+            "dtype": "uint8",
+            "scale": 1 / 255,
+            "data": base64.b64encode(weights.tobytes()).decode("ascii")
+        },
+        "headTypes": head_types,
         "model_name": model_name,
         "model_info": {
             "name": model_name,
@@ -89,7 +92,7 @@ def generate_mock_sample_data():
         
         print(f"Mock sample attention patterns saved to {output_path}")
         print(f"Number of tokens: {result['numTokens']}")
-        print(f"Number of attention patterns: {len(result['attentionPatterns'])}")
+        print(f"Attention weights shape: {result['attentionWeights']['shape']}")
 
 if __name__ == "__main__":
     generate_mock_sample_data() 
\ No newline at end of file
@@ -50,7 +50,7 @@ def generate_sample_data(output_dir=None):
             
             print(f"✅ Sample attention patterns saved to {output_path}")
             print(f"   Number of tokens: {result['numTokens']}")
-            print(f"   Number of attention patterns: {len(result['attentionPatterns'])}")
+            print(f"   Attention weights shape: {result['attentionWeights']['shape']}")
             print(f"   Tokens: {result['tokens']}")
         except Exception as e:
             print(f"❌ Error generating sample data for {model_name}: {e}")
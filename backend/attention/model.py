@@ -1,8 +1,10 @@
 import torch
 from transformer_lens import HookedTransformer
-from transformer_lens.head_detector import detect_head 
-from typing import Dict, List, Tuple, Any
+from transformer_lens.head_detector import detect_head, HEAD_NAMES
+from transformer_lens.utils import get_act_name
+from typing import Dict, List, Tuple, Any, Optional
 import numpy as np
+import base64
 
 # Available models
 AVAILABLE_MODELS = {
@@ -10,33 +12,126 @@ AVAILABLE_MODELS = {
     "pythia-2.8b": "pythia-2.8b"
 }
 
+# Reference text for head classification; the repeated half lets induction heads show up
+HEAD_TYPE_REFERENCE_TEXT = (
+    "When Mary and John went to the store, John gave a drink to Mary. "
+    "When Mary and John went to the store, John gave a drink to Mary."
+)
+# Minimum detection score for a head to be labelled with a type instead of "unknown"
+HEAD_TYPE_THRESHOLD = 0.5
+# Attention weights are sent as uint8 steps of this size; plenty for an 8-bit heatmap
+WEIGHT_SCALE = 1 / 255
+# Largest attention export (layers * heads * tokens^2 weights) for one prompt, or one padded batch
+MAX_ATTENTION_CELLS = 32 * 1024 * 1024
+# Unused memory PyTorch may keep cached on the GPU before it is handed back to the driver
+CUDA_CACHE_RELEASE_THRESHOLD = 1 << 30  # 1 GiB
+# Batch sizes and sequence lengths run once after compiling so the first requests don't
+# pay for it; a single text and a batch of two cover both shapes the batcher produces
+WARMUP_BATCH_SIZES = (1, 2)
+WARMUP_SEQ_LENGTHS = (8, 64)
+
+class PromptTooLongError(ValueError):
+    """Raised when a prompt's full attention tensor would exceed MAX_ATTENTION_CELLS."""
+
 class AttentionPatternExtractor:
-    def __init__(self, model_name: str = "gpt2-small"):
+    def __init__(self, model_name: str = "gpt2-small", compile_model: Optional[bool] = None,
+                 device: Optional[str] = None):
         """Initialize the model for attention pattern extraction.
         
         Args:
             model_name: Name of the pretrained model to use
+            compile_model: Whether to compile the model with torch.compile.
+                Defaults to compiling on GPU only.
+            device: Device to load the model on. Defaults to CUDA if available.
         """
         if model_name not in AVAILABLE_MODELS:
             raise ValueError(f"Model {model_name} not supported. Available models: {', '.join(AVAILABLE_MODELS.keys())}")
             
         self.model_name = model_name
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        # bf16 halves memory traffic and runs matmuls on Tensor Cores; CPUs are usually faster in fp32
+        self.dtype = torch.bfloat16 if self.device == "cuda" else torch.float32
         
-        print(f"Loading model {model_name} on {self.device}...")
+        print(f"Loading model {model_name} on {self.device} ({self.dtype})...")
         self.model = HookedTransformer.from_pretrained(
             AVAILABLE_MODELS[model_name],
             device=self.device,
-            dtype=torch.float32
+            dtype=self.dtype
         )
         self.model.eval()
+        # Weights are never trained here, so don't track gradients for them
+        self.model.requires_grad_(False)
         
         # Cache model configuration
         self.n_layers = self.model.cfg.n_layers
         self.n_heads = self.model.cfg.n_heads
+        # Exact hook names for the attention patterns, so run_with_hooks doesn't
+        # call a filter function on every hook point of every forward pass
+        self._pattern_hook_names = [get_act_name("pattern", layer) for layer in range(self.n_layers)]
+        
+        if compile_model is None:
+            compile_model = self.device == "cuda"
+        if compile_model:
+            self.compile()
+        
+        # Head types don't depend on the request, so classify every head once up front
+        self.head_types = self.classify_heads()
         
         print(f"Model loaded: {model_name} with {self.n_layers} layers and {self.n_heads} heads")
         
+    def compile(self):
+        """Compile the MLP of every block with torch.compile and warm it up.
+        
+        Only the MLPs are compiled: the attention modules carry the hook
+        points we attach per-request closures to, which would make dynamo
+        guard on (and recompile for) every request. Falls back to eager
+        mode if compilation fails.
+        """
+        eager_mlps = [block.mlp for block in self.model.blocks]
+        try:
+            for block in self.model.blocks:
+                # dynamic=True avoids recompiling for every new sequence length
+                block.mlp = torch.compile(block.mlp, dynamic=True)
+            with torch.inference_mode():
+                for batch_size in WARMUP_BATCH_SIZES:
+                    for seq_len in WARMUP_SEQ_LENGTHS:
+                        dummy_tokens = torch.zeros((batch_size, seq_len), dtype=torch.long, device=self.device)
+                        self.model(dummy_tokens, return_type=None)
+        except Exception as e:
+            print(f"Error compiling model, running in eager mode: {e}")
+            for block, mlp in zip(self.model.blocks, eager_mlps):
+                block.mlp = mlp
+
+    def classify_heads(self) -> List[List[str]]:
+        """Classify every attention head using transformer_lens' head detector.
+        
+        Each head is labelled with the detection pattern it scores highest on
+        for HEAD_TYPE_REFERENCE_TEXT, or "unknown" if no score reaches
+        HEAD_TYPE_THRESHOLD.
+        
+        Returns:
+            Head type names indexed as [layer][head]
+        """
+        head_types = [["unknown"] * self.n_heads for _ in range(self.n_layers)]
+        try:
+            with torch.inference_mode():
+                # One (n_layers, n_heads) score table per head type
+                scores = torch.stack([
+                    detect_head(self.model, HEAD_TYPE_REFERENCE_TEXT, head_name)
+                    for head_name in HEAD_NAMES
+                ])
+        except Exception as e:
+            print(f"Error detecting head types: {e}")
+            return head_types
+        
+        best_scores, best_types = scores.max(dim=0)
+        names = [head_name.removesuffix("_head") for head_name in HEAD_NAMES]
+        for layer in range(self.n_layers):
+            for head in range(self.n_heads):
+                if best_scores[layer, head] >= HEAD_TYPE_THRESHOLD:
+                    head_types[layer][head] = names[best_types[layer, head]]
+        return head_types
+        
     def get_attention_patterns(self, text: str) -> Dict[str, Any]:
         """Extract attention patterns from input text.
         
@@ -47,65 +142,199 @@ class AttentionPatternExtractor:
             Dictionary containing:
                 - tokens: List of tokens
                 - layerAttentions: List of attention patterns per layer
+                - headTypes: Head type names indexed as [layer][head]
         """
-        # Tokenize input text
-        tokens = self.model.to_tokens(text)
-        tokens_list = self.model.to_str_tokens(text)
-        n_tokens = len(tokens_list)
+        return self.get_attention_patterns_batch([text])[0]
+
+    def get_attention_patterns_batch(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """Extract attention patterns for several texts in one forward pass.
         
-        # Store attention patterns
-        patterns = []
+        Args:
+            texts: Input texts to analyze
+            
+        Returns:
+            One dictionary per text, in the format of get_attention_patterns
+        """
+        tokens_lists, patterns = self._extract_patterns([self.tokenize(text) for text in texts])
         
-        def save_pattern(activation, hook):
-            # Remove batch dimension and store
-            pattern = activation.detach().squeeze(0).cpu().numpy()
-            pattern = pattern[:, 1:, 1:]  # Remove BOS token
-            # Set upper triangular part to zero (prevent attending to future tokens)
-            for h in range(pattern.shape[0]):  # For each head
-                pattern[h] = np.tril(pattern[h])
-            patterns.append(pattern)
-        
-        # Run model with hooks to capture attention patterns
-        pattern_filter = lambda name: "hook_pattern" in name
-        self.model.run_with_hooks(
-            text,
-            return_type=None,
-            fwd_hooks=[(pattern_filter, save_pattern)]
+        # Convert patterns to the expected format, dropping each text's padding
+        results = []
+        for i, tokens in enumerate(tokens_lists):
+            n_tokens = len(tokens)
+            layer_attentions = []
+            for layer_idx in range(self.n_layers):
+                layer_attentions.append({
+                    "layer": layer_idx,
+                    "heads": patterns[layer_idx, i, :, :n_tokens, :n_tokens]
+                })
+            
+            results.append({
+                "tokens": tokens,
+                "layerAttentions": layer_attentions,
+                "headTypes": self.head_types
+            })
+        
+        return results
+
+    def tokenize(self, text: str) -> torch.Tensor:
+        """Tokenize a text and check that its full attention tensor is small enough to export.
+        
+        Args:
+            text: Input text to analyze
+            
+        Returns:
+            Token ids of the text, starting with BOS
+            
+        Raises:
+            PromptTooLongError: If the text would produce more than MAX_ATTENTION_CELLS attention weights
+        """
+        token_ids = self.model.to_tokens(text)[0]
+        self._check_attention_cells(len(token_ids))
+        return token_ids
+
+    def attention_cells(self, seq_len: int, batch_size: int = 1) -> int:
+        """Number of attention weights exported for batch_size texts padded to seq_len tokens (including BOS)."""
+        n_tokens = seq_len - 1  # BOS is not exported
+        return batch_size * self.n_layers * self.n_heads * n_tokens * n_tokens
+
+    def _check_attention_cells(self, seq_len: int, batch_size: int = 1):
+        """Raise PromptTooLongError if a batch's attention tensor would exceed MAX_ATTENTION_CELLS."""
+        n_cells = self.attention_cells(seq_len, batch_size)
+        if n_cells > MAX_ATTENTION_CELLS:
+            size = f"{seq_len - 1} tokens" if batch_size == 1 else f"{batch_size} texts of up to {seq_len - 1} tokens"
+            raise PromptTooLongError(
+                f"Prompt too long for full attention export: {size} would produce "
+                f"{n_cells} attention weights with model '{self.model_name}' (limit {MAX_ATTENTION_CELLS})"
+            )
+
+    def _extract_patterns(self, token_ids: List[torch.Tensor]) -> Tuple[List[List[str]], np.ndarray]:
+        """Run texts through the model as one batch and capture every layer's attention pattern.
+        
+        Texts are right-padded to the longest one. Attention is causal, so the
+        padding after a text's last token doesn't change its patterns; callers
+        slice each text's patterns down to its own number of tokens.
+        
+        Args:
+            token_ids: Token ids of each text, as returned by tokenize
+            
+        Returns:
+            Tuple containing:
+                - tokens_lists: Tokens of each text, without BOS
+                - patterns: float32 array of shape (n_layers, batch, n_heads, max_tokens, max_tokens)
+                  with the BOS token removed, indexed as [layer, text, head, dest_token, source_token]
+                  
+        Raises:
+            PromptTooLongError: If the padded batch would exceed MAX_ATTENTION_CELLS attention weights
+        """
+        # Derive the token strings from the ids and right-pad them into a single batch
+        tokens_lists = [self.model.to_str_tokens(ids)[1:] for ids in token_ids]
+        max_len = max(len(ids) for ids in token_ids)
+        # The output buffer holds the whole padded batch, so bound that before allocating it
+        self._check_attention_cells(max_len, len(token_ids))
+        
+        pad_token_id = self.model.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.model.tokenizer.eos_token_id
+        batch_tokens = torch.full((len(token_ids), max_len), pad_token_id, dtype=torch.long, device=self.device)
+        for i, ids in enumerate(token_ids):
+            batch_tokens[i, :len(ids)] = ids
+        
+        # One contiguous output buffer for all layers, filled in place by the hooks.
+        # On GPU it is page-locked so the copies run asynchronously and overlap with
+        # the rest of the forward pass; PyTorch's pinned memory allocator caches the
+        # buffer, so repeated requests reuse it.
+        pin_memory = self.device.startswith("cuda")
+        patterns = torch.empty(
+            (self.n_layers, len(token_ids), self.n_heads, max_len - 1, max_len - 1),
+            dtype=torch.float32,
+            pin_memory=pin_memory
         )
         
-        # Convert patterns to the expected format
-        layer_attentions = []
-        head_types = {}
-
-        for layer_idx, layer_pattern in enumerate(patterns):
-            # layer_pattern shape: (n_heads, seq_len, seq_len)
-            heads_attention = []
-            for head_idx in range(self.n_heads):
-                # Store the full attention matrix for each head
-                head_pattern = layer_pattern[head_idx]
-                heads_attention.append(head_pattern)
-                try:
-                    head_type = detect_head(self.model, layer_idx, head_idx)
-                    # Convert int to string if necessary
-                    if isinstance(head_type, int):
-                        head_type = f"type_{head_type}"
-                    elif head_type is None:
-                        head_type = "unknown"
-                except Exception as e:
-                    print(f"Error detecting head type: {e}")
-                    head_type = "unknown"
-                head_types[(layer_idx, head_idx)] = head_type
+        def save_pattern(activation, hook):
+            # Remove BOS token while still on the device
+            pattern = activation.detach()[:, :, 1:, 1:]
+            # Set upper triangular part to zero for all heads at once (prevent attending to future tokens)
+            pattern = pattern.tril()
+            # Upcast while copying to the host, numpy has no bfloat16
+            patterns[hook.layer()].copy_(pattern, non_blocking=True)
+        
+        # Run model with hooks to capture attention patterns (no autograd bookkeeping).
+        # Attention stays on HookedTransformer's explicit softmax(QK^T) path rather
+        # than fused SDPA/flash kernels: those never materialize the per-head
+        # pattern, and every layer's pattern is exactly what this pass exports.
+        with torch.inference_mode():
+            self.model.run_with_hooks(
+                batch_tokens,
+                return_type=None,
+                fwd_hooks=[(hook_name, save_pattern) for hook_name in self._pattern_hook_names]
+            )
+        
+        # Wait for the host copies once, after the whole forward pass has been queued
+        if pin_memory:
+            torch.cuda.current_stream(self.device).synchronize()
+            self.release_cached_memory()
+        
+        return tokens_lists, patterns.numpy()
+
+    def release_cached_memory(self):
+        """Return cached GPU memory to the driver once it exceeds CUDA_CACHE_RELEASE_THRESHOLD.
+        
+        Keeps the resident set flat when requests with very different lengths,
+        or several models, share one GPU. Emptying the cache on every request
+        would make each forward pass re-allocate from scratch, so small amounts
+        are left cached.
+        """
+        if not self.device.startswith("cuda"):
+            return
+        unused_bytes = torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        if unused_bytes > CUDA_CACHE_RELEASE_THRESHOLD:
+            torch.cuda.empty_cache()
+
+    def get_attention_weights(self, text: str) -> Tuple[List[str], np.ndarray, List[List[str]]]:
+        """Extract attention patterns as a single dense tensor.
+        
+        Args:
+            text: Input text to analyze
             
-            layer_attentions.append({
-                "layer": layer_idx,
-                "heads": heads_attention
-            })
+        Returns:
+            Tuple containing:
+                - tokens: List of tokens
+                - weights: uint8 array of shape (n_layers, n_heads, n_tokens, n_tokens),
+                  indexed as [layer, head, dest_token, source_token]; multiply by
+                  WEIGHT_SCALE to get the attention weight
+                - head_types: Head type names indexed as [layer][head]
+        """
+        return self.get_attention_weights_batch([text])[0]
+
+    def get_attention_weights_batch(self, texts: List[str]) -> List[Tuple[List[str], np.ndarray, List[List[str]]]]:
+        """Extract attention patterns as dense tensors for several texts in one forward pass.
         
-        return {
-            "tokens": tokens_list[1:],
-            "layerAttentions": layer_attentions,
-            "headTypes": head_types
-        }
+        Args:
+            texts: Input texts to analyze
+            
+        Returns:
+            One tuple per text, in the format of get_attention_weights
+        """
+        return self.get_attention_weights_from_tokens([self.tokenize(text) for text in texts])
+
+    def get_attention_weights_from_tokens(self, token_ids: List[torch.Tensor]) -> List[Tuple[List[str], np.ndarray, List[List[str]]]]:
+        """Extract attention patterns as dense tensors for already tokenized texts in one forward pass.
+        
+        Args:
+            token_ids: Token ids of each text, as returned by tokenize
+            
+        Returns:
+            One tuple per text, in the format of get_attention_weights
+        """
+        tokens_lists, patterns = self._extract_patterns(token_ids)
+        
+        results = []
+        for i, tokens in enumerate(tokens_lists):
+            n_tokens = len(tokens)
+            # Slice this text out of the batch and quantize to uint8 (rounding to nearest)
+            weights = (patterns[:, i, :, :n_tokens, :n_tokens] / WEIGHT_SCALE + 0.5).astype(np.uint8)
+            results.append((tokens, weights, self.head_types))
+        return results
 
     def process_text(self, text: str) -> Dict[str, Any]:
         """Process text and return data in the format expected by the frontend.
@@ -116,42 +345,34 @@ class AttentionPatternExtractor:
         Returns:
             Dictionary containing attention patterns and metadata
         """
-        # Get attention patterns and tokens
-        result = self.get_attention_patterns(text)
-        tokens = result["tokens"]
-        layer_attentions = result["layerAttentions"]
-        head_types = result["headTypes"]
-        
-        # Transform data into the format expected by the frontend
-        attention_patterns = []
-        
-        # For each layer
-        for layer_data in layer_attentions:
-            layer = layer_data["layer"]
-            # For each head
-            for head in range(self.n_heads):
-                head_pattern = layer_data["heads"][head]  # This is now a 2D matrix
-                # For each token pair
-                for src_idx in range(len(tokens)):
-                    for dest_idx in range(len(tokens)):
-                        # Get attention weight directly from the pattern matrix
-                        weight = float(head_pattern[dest_idx, src_idx])  # Note: matrix is [dest, src]
-                        attention_patterns.append({
-                            "sourceLayer": layer,
-                            "sourceToken": src_idx,
-                            "destLayer": layer + 1,  # Next layer
-                            "destToken": dest_idx,
-                            "weight": weight,
-                            "head": head,
-                            "headType": head_types.get((layer, head), "unknown")
-                        })
-        
-        return {
+        return self.format_result(*self.get_attention_weights(text))
+
+    def format_result(self, tokens: List[str], weights: np.ndarray, head_types: List[List[str]],
+                      encode_data: bool = True) -> Dict[str, Any]:
+        """Format extracted attention weights the way the frontend expects them.
+        
+        Args:
+            tokens: List of tokens
+            weights: Attention weights as returned by get_attention_weights
+            head_types: Head type names indexed as [layer][head]
+            encode_data: Whether to include the base64 tensor under attentionWeights.data.
+                Callers that stream large tensors encode it themselves.
+            
+        Returns:
+            Dictionary containing attention patterns and metadata
+        """
+        result = {
             "numLayers": self.n_layers + 1,  # +1 because we show source and destination layers
             "numTokens": len(tokens),
             "numHeads": self.n_heads,
             "tokens": tokens,
-            "attentionPatterns": attention_patterns,
+            # Raw quantized tensor; the client derives layer/head/token indices from the shape
+            "attentionWeights": {
+                "shape": list(weights.shape),
+                "dtype": "uint8",
+                "scale": WEIGHT_SCALE
+            },
+            "headTypes": head_types,
             "model_name": self.model_name,
             "model_info": {
                 "name": self.model_name,
@@ -160,17 +381,20 @@ class AttentionPatternExtractor:
                 "architecture": AVAILABLE_MODELS[self.model_name]
             }
         }
+        if encode_data:
+            # Encoded straight from the array buffer
+            result["attentionWeights"]["data"] = base64.b64encode(weights.data).decode("ascii")
+        return result
 
 # Example usage:
 if __name__ == "__main__":
     extractor = AttentionPatternExtractor()
     text = "The quick brown fox jumped over the lazy dog"
-    patterns = extractor.process_text(text)
-    print(f"Number of tokens: {patterns['numTokens']}")
-    print(f"Number of attention patterns: {len(patterns['attentionPatterns'])}")
-    print(f"Tokens: {patterns['tokens']}")
+    tokens, weights, head_types = extractor.get_attention_weights(text)
+    print(f"Number of tokens: {len(tokens)}")
+    print(f"Number of attention patterns: {weights.size}")
+    print(f"Tokens: {tokens}")
     print("\nSample attention patterns for first head:")
     # Print first few patterns for head 0 to verify weights
-    head_0_patterns = [p for p in patterns["attentionPatterns"] if p["head"] == 0][:5]
-    for p in head_0_patterns:
-        print(f"Source token: {patterns['tokens'][p['sourceToken']]} -> Dest token: {patterns['tokens'][p['destToken']]}, Weight: {p['weight']:.4f}")
+    for dest_idx in range(min(5, len(tokens))):
+        print(f"Source token: {tokens[0]} -> Dest token: {tokens[dest_idx]}, Weight: {weights[0, 0, dest_idx, 0] * WEIGHT_SCALE:.4f}")
@@ -22,7 +22,7 @@ After=network.target
 [Service]
 User=root
 WorkingDirectory=/root/information-flow/backend
-ExecStart=/usr/bin/python3 -m uvicorn attention.api:app --host 0.0.0.0 --port 8080
+ExecStart=/usr/bin/python3 -m uvicorn attention.api:app --host 0.0.0.0 --port 8080 --loop uvloop --http httptools
 Restart=always
 RestartSec=10
 
@@ -26,7 +26,7 @@ cd ~/information-flow/backend
 
 # Run the backend server using nohup to keep it running after SSH disconnects
 # Using port 8080 which is already being forwarded by vast.ai
-nohup python3 -m uvicorn attention.api:app --host 0.0.0.0 --port 8080 > backend.log 2>&1 &
+nohup python3 -m uvicorn attention.api:app --host 0.0.0.0 --port 8080 --loop uvloop --http httptools > backend.log 2>&1 &
 
 # Save the process ID
 echo $! > backend.pid